@@ -9,6 +9,10 @@ def simplify(name):
 result = {}
 
 for filename in os.listdir("./weightings/"):
+	if filename.endswith(".stats.json"):
+		# backend and timing stats written by extract_grade_weighting.py
+		continue
+
 	name = filename.replace(".json", "")
 	with open("./weightings/" + filename) as fd:
 		content = json.load(fd)
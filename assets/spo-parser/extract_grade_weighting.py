@@ -1,12 +1,60 @@
 import re
 import sys
 import json
-import camelot
+import time
+import pdfplumber
 
 if len(sys.argv) != 3:
 	print("Usage: extract_grade_weighting.py <pdf file> <json output file>", file=sys.stderr)
 	exit(1)
 
+def open_pdfplumber(path):
+	pdf = pdfplumber.open(path)
+	return pdf, len(pdf.pages)
+
+def extract_pdfplumber(pdf, page_number):
+	page = pdf.pages[page_number - 1]
+	tables = page.extract_tables()
+	# free the parsed page layout, SPO appendices can have a lot of pages
+	page.close()
+
+	# pdfplumber returns None for empty and spanned cells, camelot returns ""
+	return [[[col or "" for col in row] for row in table] for table in tables]
+
+def text_pdfplumber(pdf, page_number):
+	page = pdf.pages[page_number - 1]
+	text = page.extract_text() or ""
+	page.close()
+	return text
+
+def open_camelot(path):
+	# camelot is slow to import and pulls in opencv, so only load it when a page needs it
+	global camelot
+	import camelot
+	return path, None
+
+def extract_camelot(path, page_number):
+	return [table.data for table in camelot.read_pdf(path, pages=str(page_number))]
+
+# backends are tried in order and the last one is used even if validation fails.
+# open(path) is called once a backend is first needed and returns a handle and the
+# page count, which has to be known by the first backend. extract(handle, page_number)
+# returns the tables of a page, text(handle, page_number) and close(handle) are optional.
+backends = [
+	{
+		"name": "pdfplumber",
+		"open": open_pdfplumber,
+		"extract": extract_pdfplumber,
+		"text": text_pdfplumber,
+		"close": lambda pdf: pdf.close()
+	},
+	{
+		"name": "camelot",
+		"open": open_camelot,
+		"extract": extract_camelot
+	},
+]
+
 def find_col(data, needle):
 	for row in data[0 : 3]:
 		for i, col in enumerate(row):
@@ -16,30 +64,37 @@ def find_col(data, needle):
 
 	return None
 
-tables = camelot.read_pdf(sys.argv[1], pages="all")
-
-entries = []
-unfinished_table = False
-for table in tables:
-	data = table.data
+def parse_table(data, state, entries):
+	"""Parses a single table into entries.
+	Returns a list of validation problems, which is empty if the table looks fine."""
 	if len(data) < 2 or len(data[-1]) < 2:
-		continue
+		return []
 
 	is_finished = "summe" in data[-1][1].lower()
+	sum_row = data[-1]
 	if is_finished:
 		# remove sum row
 		data = data[0 : -1]
 
-	if not unfinished_table:
-		num_col = find_col(data, "lfdnr") or find_col(data, "nummer") or find_col(data, "lfd")
-		name_col = find_col(data, "modul") or find_col(data, "fächer") or find_col(data, "fach")
-		sws_col = find_col(data, "sws")
-		weight_col = find_col(data, "gewichtung")
-		ects_col = find_col(data, "punkte") or find_col(data, "ects")
+	if not state["unfinished_table"]:
+		state["num_col"] = find_col(data, "lfdnr") or find_col(data, "nummer") or find_col(data, "lfd")
+		state["name_col"] = find_col(data, "modul") or find_col(data, "fächer") or find_col(data, "fach")
+		state["sws_col"] = find_col(data, "sws")
+		state["weight_col"] = find_col(data, "gewichtung")
+		state["ects_col"] = find_col(data, "punkte") or find_col(data, "ects")
+		state["ects_sum"] = 0
+
+	num_col = state["num_col"]
+	name_col = state["name_col"]
+	sws_col = state["sws_col"]
+	weight_col = state["weight_col"]
+	ects_col = state["ects_col"]
 
 	if any(x is None for x in [num_col, name_col, sws_col, weight_col, ects_col]):
 		# ignore tables which dont list modules
-		continue
+		if weight_col is not None:
+			return ["incomplete header"]
+		return []
 
 	if data[0][0 : 3] == ["1", "2", "3"]:
 		# skip first line which contains column indices
@@ -67,25 +122,174 @@ for table in tables:
 
 		try:
 			ects = int(row[ects_col])
-		except ValueError:
+		except (ValueError, IndexError):
 			ects = None
 
 		try:
 			workload = int(row[sws_col])
-		except ValueError:
+		except (ValueError, IndexError):
 			workload = None
 
+		if ects is not None:
+			state["ects_sum"] += ects
+
 		entries.append({
 			"apo_number": apo_num,
-			"name": re.sub("\\s+", " ", row[name_col]),
+			"name": re.sub("\\s+", " ", row[name_col]) if name_col < len(row) else "",
 			"weekly_workload": workload,
 			"weight": weight,
 			"ects": ects
 		})
 
-	unfinished_table = not is_finished
+	state["unfinished_table"] = not is_finished
+
+	if is_finished and ects_col < len(sum_row):
+		try:
+			expected = int(sum_row[ects_col])
+		except ValueError:
+			expected = None
+
+		if expected is not None and expected != state["ects_sum"]:
+			return ["ECTS sum {} does not match sum row {}".format(state["ects_sum"], expected)]
+
+	return []
+
+def continues_table(data, state):
+	"""Checks if a table has no header of its own but module rows in the columns of the last table."""
+	if find_col(data, "gewichtung") is not None:
+		return False
+
+	for row in data:
+		if state["num_col"] >= len(row) or state["ects_col"] >= len(row):
+			continue
+
+		apo_num = row[state["num_col"]].strip()
+		if re.match(r"^\d+(\.\d+)*\.?$", apo_num) is not None and row[state["ects_col"]].strip().isdigit():
+			return True
+
+	return False
+
+def parse_chunk(handle, start, num_pages, backend, state, is_last):
+	"""Parses the pages from start until no table is left unfinished, using a single backend
+	so the columns of a table spanning several pages are always detected by the same backend.
+	Unless this is the last backend, parsing stops at the first page which fails validation.
+	Returns the entries, the next page number and the stats of the parsed pages."""
+	entries = []
+	page_stats = []
+	page_number = start
+	while page_number <= num_pages:
+		open_table = state["unfinished_table"]
+		after_empty_page = state.pop("after_empty_page", False)
+
+		start_time = time.perf_counter()
+		tables = backend["extract"](handle, page_number)
+		problems = []
+		if after_empty_page and len(tables) > 0 and continues_table(tables[0], state):
+			if is_last:
+				# keep the table open across the page without tables
+				state["unfinished_table"] = True
+			else:
+				problems.append("table continues after a page without tables")
+
+		table_stats = []
+		for data in tables:
+			num_entries = len(entries)
+			problems += parse_table(data, state, entries)
+			table_stats.append({
+				"backend": backend["name"],
+				"rows": len(data),
+				"entries": len(entries) - num_entries
+			})
+		duration = time.perf_counter() - start_time
+
+		if len(tables) == 0:
+			if open_table:
+				# a page without tables ends the open table, e.g. if it has no sum row.
+				# the next page is still parsed in this chunk in case the table continues there
+				state["unfinished_table"] = False
+				state["after_empty_page"] = True
+			elif not is_last and "text" in backend and "gewichtung" in backend["text"](handle, page_number).lower():
+				problems.append("no tables found")
+
+		page_stats.append({
+			"page": page_number,
+			"backend": backend["name"],
+			"time": round(duration, 3),
+			"tables": table_stats,
+			"problems": problems
+		})
+		page_number += 1
+
+		if len(problems) > 0 and not is_last:
+			break
+		if not state["unfinished_table"] and not state.get("after_empty_page", False):
+			break
+
+	return entries, page_number, page_stats
+
+def parse_pages(path):
+	"""Parses all pages, falling back to the next backend for every chunk of pages
+	which fails validation. The chunk is re-run from the page its first table started on.
+	Returns the entries and the stats of all tried pages."""
+	entries = []
+	stats = {"pages": [], "rejected": []}
+	state = {"unfinished_table": False}
+	handles = {}
+
+	handles[backends[0]["name"]], num_pages = backends[0]["open"](path)
+
+	page_number = 1
+	while page_number <= num_pages:
+		for i, backend in enumerate(backends):
+			name = backend["name"]
+			if name not in handles:
+				handles[name], _ = backend["open"](path)
+
+			is_last = i == len(backends) - 1
+			chunk_state = dict(state)
+			chunk_entries, next_page, page_stats = parse_chunk(handles[name], page_number, num_pages, backend, chunk_state, is_last)
+
+			if is_last or all(len(x["problems"]) == 0 for x in page_stats):
+				break
+
+			for x in page_stats:
+				if len(x["problems"]) > 0:
+					print("Page {}: {} failed in {:.2f}s ({})".format(x["page"], name, x["time"], ", ".join(x["problems"])))
+			stats["rejected"] += page_stats
+
+		for x in page_stats:
+			print("Page {}: {} table(s) from {} in {:.2f}s".format(x["page"], len(x["tables"]), x["backend"], x["time"]))
+		stats["pages"] += page_stats
+
+		entries += chunk_entries
+		state = chunk_state
+		page_number = next_page
+
+	for backend in backends:
+		if backend["name"] in handles and "close" in backend:
+			backend["close"](handles[backend["name"]])
+
+	stats["backends"] = {
+		backend["name"]: {
+			"pages": sum(1 for x in stats["pages"] if x["backend"] == backend["name"]),
+			"tables": sum(len(x["tables"]) for x in stats["pages"] if x["backend"] == backend["name"]),
+			"time": round(sum(x["time"] for x in stats["pages"] + stats["rejected"] if x["backend"] == backend["name"]), 3)
+		}
+		for backend in backends
+	}
+
+	return entries, stats
+
+entries, stats = parse_pages(sys.argv[1])
 
 with open(sys.argv[2], "w+") as fd:
 	json.dump(entries, fd)
 
+# per page and per table backend and timing, ignored by combine_jsons.py
+with open(re.sub(r"\.json$", "", sys.argv[2]) + ".stats.json", "w+") as fd:
+	json.dump(stats, fd, indent="\t")
+
+for name, backend_stats in stats["backends"].items():
+	print("{}: {} page(s), {} table(s), {:.2f}s".format(name, backend_stats["pages"], backend_stats["tables"], backend_stats["time"]))
+
 print("ECTS sum:", sum(x["ects"] for x in entries if x["ects"] is not None))